@@ -1,47 +1,319 @@
+import atexit
+import base64
 import click
+import functools
 import json
-import ldap3
 
-from ldap3.core.exceptions import LDAPException
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 from pyadm.config import config
 
+try:
+    import orjson
+except ImportError:  # optional, falls back to the standard library
+    orjson = None
+
 defaults = {
     "server": "ldap://localhost",
     "base_dn": "dc=example,dc=org",
     "username": "root@example.org",
     "password": "s3cur3_p455w0rd",
+    "page_size": 500,
+    "search_timeout": 10,
+    "fetch_schema": False,
 }
 
 click_options = {}
 
+# ldap3 is imported inside the functions that talk to the server, so `--help`
+# and argument errors do not pay for loading it
+
 def prompt_password_if_needed(ctx, param, value):
     if value:  # `-p` was provided without an argument
         return click.prompt("Specify the password for authentication", hide_input=True)
     return None  # Default value, if `-p` was not provided at all.
 
-def ldap_search(click_options, search_filter, attributes=[]):
+# bound connections, keyed like the sections ldap_server_options deduplicates,
+# reused for the lifetime of the process
+_connection_cache = {}
+
+def ldap_connection_key(click_options):
+    return (click_options["server"], click_options["username"], click_options["base_dn"])
+
+def ldap_connect(click_options):
+    key = ldap_connection_key(click_options)
+    # exclusive connections are taken out of the cache while in use, so no other
+    # thread searches on them at the same time, ldap_release puts them back
+    exclusive = click_options.get("exclusive_connection")
+    conn = _connection_cache.pop(key, None) if exclusive else _connection_cache.get(key)
+    if conn is not None and conn.bound:
+        return conn
+
+    conn = ldap_open(click_options)
+    if not exclusive:
+        _connection_cache[key] = conn
+    return conn
+
+def ldap_release(click_options, conn):
+    # return an exclusive connection to the cache, unless another search already put one there
+    if not conn.bound or _connection_cache.setdefault(ldap_connection_key(click_options), conn) is not conn:
+        ldap_unbind(conn)
+
+def ldap_open(click_options):
+    import ldap3
+
+    # reading the schema costs an extra search per connection, it is only needed
+    # to convert values like timestamps or SIDs into their native types
+    get_info = ldap3.SCHEMA if click_options.get("fetch_schema") else ldap3.NONE
+    server = ldap3.Server(click_options["server"], get_info=get_info, connect_timeout=5)
+    # give the server its full search time limit before the client stops waiting,
+    # a search_timeout of 0 leaves both unlimited
+    search_timeout = click_options.get("search_timeout", defaults["search_timeout"])
+    receive_timeout = search_timeout + 5 if search_timeout else None
+    conn = ldap3.Connection(server, user=click_options["username"], password=click_options["password"],
+                            auto_bind=True, receive_timeout=receive_timeout, read_only=True,
+                            auto_referrals=False)
+    return conn
+
+def ldap_unbind(conn):
+    from ldap3.core.exceptions import LDAPException
+
     try:
-        server_url = click_options["server"]
-        bind_dn = click_options["username"]
-        bind_password = click_options["password"]
+        conn.unbind()
+    except LDAPException:
+        pass
+
+def ldap_reconnect(click_options, conn):
+    # drop a stale connection and open a new one in its place
+    key = ldap_connection_key(click_options)
+    if _connection_cache.get(key) is conn:
+        del _connection_cache[key]
+    ldap_unbind(conn)
+    return ldap_connect(click_options)
+
+@atexit.register
+def ldap_disconnect():
+    for conn in _connection_cache.values():
+        ldap_unbind(conn)
+    _connection_cache.clear()
 
-        server = ldap3.Server(server_url)
-        conn = ldap3.Connection(server, user=bind_dn, password=bind_password)
-        conn.open()
-        conn.bind()
+def ldap_search(click_options, search_filter, attributes=[], size_limit=1000, time_limit=None, paged_size=None,
+                raw=False):
+    if "servers" in click_options:
+        return ldap_search_all(click_options, search_filter, attributes, size_limit, time_limit, paged_size, raw)
 
+    from ldap3.core.exceptions import (LDAPException, LDAPSessionTerminatedByServerError,
+                                       LDAPSocketOpenError, LDAPSocketSendError)
+
+    conn = None
+    try:
+        conn = ldap_connect(click_options)
         base_dn = click_options["base_dn"]
 
-        conn.search(base_dn, search_filter, attributes=attributes)
+        if paged_size is None:
+            paged_size = click_options.get("page_size", defaults["page_size"])
+        if time_limit is None:
+            time_limit = click_options.get("search_timeout", defaults["search_timeout"])
 
-        result_entries = conn.entries
-        return result_entries
+        def search(conn):
+            if paged_size:
+                # collects every page into conn.response, so conn.entries covers the whole result
+                conn.extend.standard.paged_search(base_dn, search_filter, attributes=attributes,
+                                                  size_limit=size_limit, time_limit=time_limit,
+                                                  paged_size=paged_size, generator=False)
+            else:
+                conn.search(base_dn, search_filter, attributes=attributes,
+                            size_limit=size_limit, time_limit=time_limit)
+
+        try:
+            search(conn)
+        except (LDAPSessionTerminatedByServerError, LDAPSocketOpenError, LDAPSocketSendError):
+            # the cached connection went stale, rebuild it once and retry. Receive errors are
+            # not retried, ldap3 also raises those for timeouts and a slow search would run twice
+            conn = ldap_reconnect(click_options, conn)
+            search(conn)
+
+        if raw:
+            # plain dicts straight from the response, without building ldap3 Entry objects
+            result_entries = [response_to_dict(response) for response in conn.response or []
+                              if response["type"] == "searchResEntry"]
+        else:
+            result_entries = conn.entries
     except LDAPException as e:
+        # an exclusive connection whose search failed is not handed on to the next search
+        if conn is not None and click_options.get("exclusive_connection"):
+            ldap_unbind(conn)
         raise click.ClickException(f"LDAP search failed: {e}")
 
+    if click_options.get("exclusive_connection"):
+        ldap_release(click_options, conn)
+    return result_entries
+
+def ldap_section_int(section, key):
+    # integer setting of a config section, [LDAP_<NAME>] sections fall back to [LDAP]
+    for name in dict.fromkeys((section, "LDAP")):
+        if config.has_option(name, key):
+            try:
+                return config.getint(name, key)
+            except ValueError:
+                raise click.ClickException(f"{key} in [{name}] must be an integer, not '{config.get(name, key)}'.")
+    return defaults[key]
+
+def ldap_section_options(section, base_dn=None, username=None, password=None):
+    # connection options of one config section, typed once here instead of on every connect
+    section_config = config[section] if config.has_section(section) else config[config.default_section]
+    return {
+        "server": section_config.get("server") or defaults["server"],
+        "base_dn": base_dn or section_config.get("base_dn") or defaults["base_dn"],
+        "username": username or section_config.get("bind_username") or defaults["username"],
+        "password": password or section_config.get("bind_password") or defaults["password"],
+        "page_size": ldap_section_int(section, "page_size"),
+        "search_timeout": ldap_section_int(section, "search_timeout"),
+        "fetch_schema": section_config.getboolean("fetch_schema", fallback=defaults["fetch_schema"]),
+    }
+
+def ldap_server_options(base_dn=None, username=None, password=None):
+    # one set of connection options per [LDAP] and [LDAP_<NAME>] section, skipping duplicates
+    servers = {}
+    for section in config.sections():
+        if section != "LDAP" and not section.startswith("LDAP_"):
+            continue
+        options = ldap_section_options(section, base_dn, username, password)
+        servers.setdefault((options["server"], options["username"], options["base_dn"]), options)
+    return list(servers.values())
+
+def ldap_search_all(click_options, search_filter, *args):
+    # query every configured server concurrently and return the first non-empty result.
+    # Searches still running then are left to finish in the background, so the workers
+    # hold their connections exclusively instead of sharing them with the next search
+    servers = [dict(options, exclusive_connection=True) for options in click_options["servers"]]
+    if not servers:
+        raise click.ClickException("No [LDAP] or [LDAP_*] sections found in the configuration file.")
+
+    executor = ThreadPoolExecutor(max_workers=len(servers))
+    futures = {executor.submit(ldap_search, options, search_filter, *args): options["server"]
+               for options in servers}
+    errors = []
+    try:
+        for future in as_completed(futures):
+            try:
+                result_entries = future.result()
+            except click.ClickException as e:
+                errors.append(f"{futures[future]}: {e.format_message()}")
+                continue
+            if result_entries:
+                return result_entries
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    # a server that failed may hold what the others do not, so an empty result is not reported as such
+    if len(errors) == len(futures):
+        raise click.ClickException(f"The search failed on every server: {'; '.join(errors)}")
+    if errors:
+        raise click.ClickException(f"Nothing found on the servers that answered, "
+                                   f"the search failed on {'; '.join(errors)}")
+    return []
+
+# Active Directory attributes holding binary data, lower-cased
+binary_attributes = frozenset((
+    "objectguid", "objectsid", "sidhistory", "tokengroups", "msexchmailboxguid", "msexchmasteraccountsid",
+    "ms-ds-consistencyguid", "msds-generationid", "jpegphoto", "thumbnailphoto", "usercertificate",
+    "cacertificate",
+))
+
+def binary_values(attr, values, raw_values):
+    # without the schema ldap3 hands out binary values that happen to be valid UTF-8 as text,
+    # use the bytes the server sent for them, unless the schema formatted the value (e.g. as a GUID)
+    if attr.lower() not in binary_attributes:
+        return values
+    return [raw if isinstance(value, str) and value.encode("utf-8") == raw else value
+            for value, raw in zip(values, raw_values)]
+
+def format_value(value):
+    # binary values are shown base64 encoded instead of as a Python bytes literal
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode("ascii")
+    return str(value)
+
+def format_entry(entry):
+    # map attribute names to lists of strings, only converting values that are not strings already
+    entry_info = {}
+    for attr in entry.entry_attributes:
+        values = binary_values(attr, entry[attr].values, entry[attr].raw_values)
+        if all(isinstance(value, str) for value in values):
+            entry_info[attr] = values
+        else:
+            entry_info[attr] = [format_value(value) for value in values]
+    return entry_info
+
+def json_default(value):
+    # binary values keep ldap3's tagged base64 form
+    if isinstance(value, bytes):
+        return {"encoded": base64.b64encode(value).decode("ascii"), "encoding": "base64"}
+    return str(value)
+
+def dump_json(data):
+    if orjson is not None:
+        # pass datetimes to json_default too, so both encoders format them the same way
+        option = orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        return orjson.dumps(data, default=json_default, option=option).decode()
+    return json.dumps(data, default=json_default, indent=2, sort_keys=True, ensure_ascii=False)
+
+def response_to_dict(response):
+    # single-valued attributes come back as scalars when the schema is known, list them like entries do
+    attributes = {}
+    for attr, values in response["attributes"].items():
+        values = values if isinstance(values, list) else [values]
+        attributes[attr] = binary_values(attr, values, response["raw_attributes"].get(attr, []))
+    return {"dn": response["dn"], "attributes": attributes}
+
+@functools.lru_cache(maxsize=64)
+def attribute_order(attributes):
+    # entries of one search usually share their attribute set, sort it only once
+    return sorted(attributes)
+
+# attributes printed as one value per line instead of comma separated
+multiline_attributes = frozenset(("memberOf", "objectClass", "member"))
+
+def print_entry(entry, json_output, bullet=" - ", dn=None, separator=False):
+    # with json_output, entry is a dict from ldap_search(..., raw=True)
+    if json_output:
+        print(dump_json(entry))
+        return
+
+    # collect the lines first, so the entry is written with a single call;
+    # separator puts a blank line before it, dn a "dn:" line at the top
+    lines = [""] if separator else []
+    if dn is not None:
+        lines.append(f"dn: {dn}")
+    entry_info = format_entry(entry)
+    for attr in attribute_order(frozenset(entry_info)):
+        values = entry_info[attr]
+        if attr in multiline_attributes:
+            lines.append(f"{attr}:")
+            lines.extend(f"{bullet}{value}" for value in values)
+        else:
+            lines.append(f"{attr}: {', '.join(values)}")
+    if any(lines):
+        print("\n".join(lines))
+
+@functools.lru_cache(maxsize=256)
+def user_filter(username):
+    # match a user by uid, cn or mail, with the input escaped for use in a filter
+    from ldap3.utils.conv import escape_filter_chars
+
+    identifier = escape_filter_chars(username)
+    return f"(|(uid={identifier})(cn={identifier})(mail={identifier}))"
+
+@functools.lru_cache(maxsize=256)
+def group_filter(group_cn):
+    from ldap3.utils.conv import escape_filter_chars
+
+    return f"(cn={escape_filter_chars(group_cn)})"
+
 # define click commands
 @click.group("ldap")
-@click.option("--server", "-s", help="Specify the LDAP server.")
+@click.option("--server", "-s", help="Specify the LDAP server, or 'all' to query every configured server.")
 @click.option("--base_dn", "-b", help="Specify the base DN (Distinguished Name).")
 @click.option("--username", "-u", help="Specify the username for authentication.")
 @click.option("--password", "-p", help="Specify the password for authentication.",
@@ -78,25 +350,34 @@ def ldapcli(server, base_dn, username, password):
     base_dn = dc=example,dc=org
     bind_username = administrator@example.org
     bind_password = s3cr3t-p455w0rd!
+    page_size = 500
+    search_timeout = 10
+    fetch_schema = false
+    
+    \b
+    Additional servers, e.g. replicas, can be added as [LDAP_<NAME>] sections
+    with the same keys. 'pyadm ldap --server all COMMAND' queries all of them
+    concurrently and shows the first server's answer that is not empty.
     
     """
-    if not (server or base_dn or username or password):
-        click_options["server"] = config["LDAP"]["server"] or defaults["server"]
-        click_options["base_dn"] = config["LDAP"]["base_dn"] or defaults["base_dn"]
-        click_options["username"] = config["LDAP"]["bind_username"] or defaults["username"]
-        click_options["password"] = config["LDAP"]["bind_password"] or defaults["password"]
-    else:
+    click_options.update(ldap_section_options("LDAP"))
+    if server or base_dn or username or password:
         click_options["server"] = server or defaults["server"]
         click_options["base_dn"] = base_dn or defaults["base_dn"]
         click_options["username"] = username or defaults["username"]
         click_options["password"] = password or defaults["password"]
+    if server == "all":
+        click_options["servers"] = ldap_server_options(base_dn, username, password)
+    else:
+        click_options.pop("servers", None)
 
 # show information about a user
 @ldapcli.command("user")
 @click.argument("username", metavar="[UID, CN, MAIL]")
 @click.option("--all", "-a", is_flag=True, default=None, help="Show all attributes")
+@click.option("--operational", "-o", is_flag=True, default=None, help="Include operational attributes (with --all)")
 @click.option("--json", "-j", "json_output", is_flag=True, default=None, help="Output as JSON")
-def user(username, json_output, all):
+def user(username, json_output, all, operational):
     """Show information about a user specified by [UID], [CN], or [MAIL].
 
     This command allows you to retrieve detailed information about a user
@@ -109,31 +390,71 @@ def user(username, json_output, all):
     $ pyadm ldap user "John Doe"        # Retrieve information for user with CN 'John Doe'
     $ pyadm ldap user jdoe@example.com  # Retrieve information for user with MAIL 'jdoe@example.com'
     """
-    search_filter = f"(|(uid={username})(cn={username})(mail={username}))"
+    search_filter = user_filter(username)
+    try:
+        if all:
+            attributes = ["*", "+"] if operational else ["*"]
+            result = ldap_search(click_options, search_filter, attributes, size_limit=1, raw=json_output)
+        else:
+            attributes = ["cn", "mail", "memberOf"]
+            result = ldap_search(click_options, search_filter, attributes, size_limit=1, raw=json_output)
+
+        if result:
+            print_entry(result[0], json_output)
+        else:
+            raise click.ClickException(f"No user found with UID '{username}'.")
+    except click.ClickException as e:
+        raise e
+    except Exception as e:
+        raise click.ClickException(f"An error occurred: {e}")
+
+# show information about several users at once
+users_chunk_size = 500
+
+@ldapcli.command("users")
+@click.argument("usernames", nargs=-1, required=True, metavar="[UID, CN, MAIL]...")
+@click.option("--all", "-a", is_flag=True, default=None, help="Show all attributes")
+@click.option("--operational", "-o", is_flag=True, default=None, help="Include operational attributes (with --all)")
+@click.option("--json", "-j", "json_output", is_flag=True, default=None, help="Output as JSON")
+def users(usernames, json_output, all, operational):
+    """Show information about several users specified by [UID], [CN], or [MAIL].
+
+    This command works like 'pyadm ldap user', but looks up the given users
+    with one LDAP search per 500 users instead of one search per user. Use it
+    for bulk lookups and audits instead of calling 'pyadm ldap user' in a loop.
+    The users are listed in the order of their DNs.
+
+    \b
+    Examples:
+    $ pyadm ldap users jdoe jroe                 # Retrieve information for users 'jdoe' and 'jroe'
+    $ pyadm ldap users jdoe "Jane Roe" --json    # Retrieve both users as a JSON list
+    """
+    identifiers = list(dict.fromkeys(usernames))
     try:
         if all:
-            attributes = ["*"]
-            result = ldap_search(click_options, search_filter, attributes)
+            attributes = ["*", "+"] if operational else ["*"]
         else:
             attributes = ["cn", "mail", "memberOf"]
-            result = ldap_search(click_options, search_filter, attributes)
+
+        # keep each OR filter small enough for server-side filter and size limits,
+        # an entry matched by several chunks is only shown once. Paged searches return
+        # each page in reverse, so the entries are sorted by DN for a stable output
+        result = {}
+        for start in range(0, len(identifiers), users_chunk_size):
+            sub_filters = "".join(map(user_filter, identifiers[start:start + users_chunk_size]))
+            search_filter = f"(|{sub_filters})"
+            for entry in ldap_search(click_options, search_filter, attributes, size_limit=0, raw=json_output):
+                result.setdefault(entry["dn"] if json_output else entry.entry_dn, entry)
+        result = [result[dn] for dn in sorted(result, key=str.lower)]
 
         if result:
             if json_output:
-                user_info = result[0].entry_to_json()
-                print(user_info)
+                print(dump_json(result))
             else:
-                user_info = result[0].entry_attributes_as_dict
-                user_info = {str(attr): [str(value) for value in values] for attr, values in user_info.items()}
-                for attr, values in sorted(user_info.items()):
-                    if attr == "memberOf" or attr == "objectClass":
-                        print(f"{attr}:")
-                        for group in values:
-                            print(f" - {group}")
-                    else:
-                        print(f"{attr}: {', '.join(values)}")
+                for index, entry in enumerate(result):
+                    print_entry(entry, json_output, dn=entry.entry_dn, separator=bool(index))
         else:
-            raise click.ClickException(f"No user found with UID '{username}'.")
+            raise click.ClickException(f"No users found for {', '.join(usernames)}.")
     except click.ClickException as e:
         raise e
     except Exception as e:
@@ -157,27 +478,15 @@ def groups(username, json_output):
     $ pyadm ldap groups "John Doe"        # Retrieve groups for user with CN 'John Doe'
     $ pyadm ldap groups jdoe@example.com  # Retrieve groups for user with MAIL 'jdoe@example.com'
     """
-    search_filter = f"(|(uid={username})(cn={username}))"
+    search_filter = user_filter(username)
     try:
         attributes = ["memberOf"]
-        result = ldap_search(click_options, search_filter, attributes)
+        result = ldap_search(click_options, search_filter, attributes, size_limit=1, raw=json_output)
 
         if result:
-            if json_output:
-                group_info = result[0].entry_to_json()
-                print(group_info)
-            else:
-                group_info = result[0].entry_attributes_as_dict
-                group_info = {str(attr): [str(value) for value in values] for attr, values in group_info.items()}
-                for attr, values in sorted(group_info.items()):
-                    if attr == "memberOf" or attr == "objectClass":
-                        print(f"{attr}:")
-                        for group in values:
-                            print(f" - {group}")
-                    else:
-                        print(f"{attr}: {', '.join(values)}")
+            print_entry(result[0], json_output)
         else:
-            raise click.ClickException(f"No user found with UID '{uid}'.")
+            raise click.ClickException(f"No user found with UID '{username}'.")
     except click.ClickException as e:
         raise e
     except Exception as e:
@@ -187,8 +496,9 @@ def groups(username, json_output):
 @ldapcli.command("members")
 @click.argument("group_cn", metavar="[GROUP]")
 @click.option("--all", "-a", is_flag=True, default=None, help="Show all attributes")
+@click.option("--operational", "-o", is_flag=True, default=None, help="Include operational attributes (with --all)")
 @click.option("--json", "-j", "json_output", is_flag=True, default=None, help="Output as JSON")
-def members(group_cn, json_output, all):
+def members(group_cn, json_output, all, operational):
     """
     Show members of a group specified by [GROUP].
 
@@ -200,31 +510,19 @@ def members(group_cn, json_output, all):
     $ pyadm ldap members "Developers"     # Retrieve members of the group with CN 'Developers'
     $ pyadm ldap members "Admins"         # Retrieve members of the group with CN 'Admins'
     """
-    search_filter = f"(cn={group_cn})"
+    search_filter = group_filter(group_cn)
     try:
         if all:
-            attributes = ["*"]
-            result = ldap_search(click_options, search_filter, attributes)
+            attributes = ["*", "+"] if operational else ["*"]
+            result = ldap_search(click_options, search_filter, attributes, size_limit=1, raw=json_output)
         else:
             attributes = ["cn", "description", "member"]
-            result = ldap_search(click_options, search_filter, attributes)
+            result = ldap_search(click_options, search_filter, attributes, size_limit=1, raw=json_output)
 
         if result:
-            if json_output:
-                group_info = result[0].entry_to_json()
-                print(group_info)
-            else:
-                group_info = result[0].entry_attributes_as_dict
-                group_info = {str(attr): [str(value) for value in values] for attr, values in group_info.items()}
-                for attr, values in sorted(group_info.items()):
-                    if attr == "member" or attr == "objectClass":
-                        print(f"{attr}:")
-                        for group in values:
-                            print(f"  - {group}")
-                    else:
-                        print(f"{attr}: {', '.join(values)}")
+            print_entry(result[0], json_output, bullet="  - ")
         else:
-            raise click.ClickException(f"No user found with UID '{group_cn}'.")
+            raise click.ClickException(f"No group found with CN '{group_cn}'.")
     except click.ClickException as e:
         raise e
     except Exception as e: